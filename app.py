@@ -1,13 +1,24 @@
 import pandas as pd
+import numpy as np
 import plotly.express as px
-from dash import Dash, dcc, html, Input, Output, dash_table, State
+from dash import Dash, dcc, html, Input, Output, dash_table, State, DiskcacheManager
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine
 import re
 import io
+import time
+import threading
+import pickle
+import inspect
+import hmac
+from collections import OrderedDict
+from functools import wraps
+import diskcache
+import psutil
 import dash
+import flask
 from dash import dcc, html, Input, Output, State
 
 
@@ -231,8 +242,325 @@ def get_medicacao_data():
     return df, df_grouped, df_yearly_cost
 
 
+def build_consultas_timeline(df_consultas):
+    # Frame ordenado por PROCESSO + offsets, para obter as consultas de um utente sem varrer a tabela toda
+    df_timeline = df_consultas[["PROCESSO", "DATACONSULTA", "CODTIPOACTIVIDADE", "AGENDA_PROTECTED"]].copy()
+    df_timeline["CODTIPOACTIVIDADE"] = pd.to_numeric(df_timeline["CODTIPOACTIVIDADE"], errors="coerce").astype("Int64")
+
+    tipo_map = {
+        1: "PRIMEIRA CONSULTA",
+        2: "CONSULTA SUBSEQUENTE"
+    }
+    df_timeline["TIPO_ACTIVIDADE_DESC"] = df_timeline["CODTIPOACTIVIDADE"].map(tipo_map).fillna("OUTRO")
+
+    df_timeline = df_timeline.sort_values(by=["PROCESSO", "DATACONSULTA"], kind="mergesort").reset_index(drop=True)
+
+    processos, inicios, contagens = np.unique(df_timeline["PROCESSO"].to_numpy(), return_index=True, return_counts=True)
+    offsets = {
+        processo: (inicio, inicio + contagem)
+        for processo, inicio, contagem in zip(processos.tolist(), inicios.tolist(), contagens.tolist())
+    }
+
+    return df_timeline, offsets
+
+
+def get_consultas_processo(df_timeline, offsets, processo):
+    if processo not in offsets:
+        return df_timeline.iloc[0:0]
+
+    inicio, fim = offsets[processo]
+    return df_timeline.iloc[inicio:fim]
+
+#____________________________________________________________________________________________________BACKGROUND JOBS________________________________
+
+# Pasta local usada pelo gestor de callbacks em background e pelos snapshots dos dados
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, "snapshots")
+os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+REFRESH_MIN_AGE = 240  # seconds, evita que vários utilizadores façam o mesmo refresh
+REFRESH_CLAIM_TIMEOUT = 60  # seconds, permite novo pedido se o job de refresh nunca chegar a arrancar
+REFRESH_LOCK_TIMEOUT = 900  # seconds, limite para o lock mesmo que o pid seja reutilizado
+MAX_EXPORT_JOBS = int(os.getenv("MAX_EXPORT_JOBS", "2"))
+EXPORT_CHUNK_ROWS = 500
+
+background_cache = diskcache.Cache(os.path.join(CACHE_DIR, "background"))
+background_callback_manager = DiskcacheManager(background_cache)
+
+
+def build_snapshot(set_progress=None):
+    def progresso(texto):
+        if set_progress:
+            set_progress(texto)
+
+    progresso("A carregar utentes...")
+    df_utente_info = get_utente_data()
+    df_utente_info.columns = df_utente_info.columns.str.upper()
+    df_utente_info["PROCESSO"] = df_utente_info["PROCESSO"].astype(str)
+
+    progresso("A carregar medicação...")
+    medicacao = get_medicacao_data()
+
+    progresso("A carregar consultas...")
+    consultas = get_consulta_data(df_utente_info)
+
+    progresso("A indexar consultas por processo...")
+    timeline = build_consultas_timeline(consultas[0])
+
+    return {"utente": df_utente_info, "medicacao": medicacao, "consultas": consultas, "timeline": timeline}
+
+
+def snapshot_path(data_version):
+    return os.path.join(SNAPSHOT_DIR, f"{data_version:012d}.pkl")
+
+
+def next_data_version():
+    # Contador monotónico partilhado pelos processos: não depende do relógio nem da hora de verão
+    return background_cache.incr("data_version_seq")
+
+
+def publish_data_version(data_version):
+    with background_cache.transact():
+        if data_version > background_cache.get("data_version", 0):
+            background_cache.set("data_version", data_version)
+        background_cache.set("data_refreshed_at", time.time())
+
+
+def write_snapshot(snapshot):
+    # Escreve para um ficheiro temporário e só depois publica a nova versão
+    data_version = next_data_version()
+    path = snapshot_path(data_version)
+    pd.to_pickle(snapshot, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    publish_data_version(data_version)
+
+    # Mantém apenas os dois snapshots mais recentes; quem escreve tem o lock, os .tmp restantes são de jobs terminados
+    snapshots = sorted(nome for nome in os.listdir(SNAPSHOT_DIR) if nome.endswith(".pkl"))
+    for nome in snapshots[:-2] + [nome for nome in os.listdir(SNAPSHOT_DIR) if nome.endswith(".tmp")]:
+        os.remove(os.path.join(SNAPSHOT_DIR, nome))
+
+    return data_version
+
+
+def current_data_version():
+    return background_cache.get("data_version", SEED_DATA_VERSION)
+
+
+def acquire_refresh_lock():
+    if background_cache.add("refresh-lock", os.getpid(), expire=REFRESH_LOCK_TIMEOUT):
+        return True
+
+    # Um job morto não chega a libertar o lock: liberta-o se o processo já não existe
+    with background_cache.transact():
+        pid = background_cache.get("refresh-lock")
+        if pid is not None and not psutil.pid_exists(pid):
+            background_cache.delete("refresh-lock")
+
+    return background_cache.add("refresh-lock", os.getpid(), expire=REFRESH_LOCK_TIMEOUT)
+
+
+def release_refresh_lock():
+    with background_cache.transact():
+        if background_cache.get("refresh-lock") == os.getpid():
+            background_cache.delete("refresh-lock")
+
+
+def refresh_running():
+    pid = background_cache.get("refresh-lock")
+    return pid is not None and psutil.pid_exists(pid)
+
+
+def claim_refresh():
+    # Só o primeiro cliente que encontra os dados desatualizados dispara o job
+    refreshed_at = background_cache.get("data_refreshed_at", 0)
+    if time.time() - refreshed_at < REFRESH_MIN_AGE or refresh_running():
+        return False
+    return background_cache.add("refresh-requested", os.getpid(), expire=REFRESH_CLAIM_TIMEOUT)
+
+
+def _export_pids():
+    return [pid for pid in background_cache.get("export-pids", []) if psutil.pid_exists(pid)]
+
+
+def export_slot_available():
+    return len(_export_pids()) < MAX_EXPORT_JOBS
+
+
+def acquire_export_slot():
+    # Os pids de jobs cancelados (mortos) deixam de contar
+    with background_cache.transact():
+        pids = _export_pids()
+        if len(pids) >= MAX_EXPORT_JOBS:
+            return False
+        background_cache.set("export-pids", pids + [os.getpid()])
+    return True
+
+
+def release_export_slot():
+    with background_cache.transact():
+        background_cache.set("export-pids", [pid for pid in _export_pids() if pid != os.getpid()])
+
+
+# Os dados calculados no arranque são uma versão publicada como as outras, sem ficheiro:
+# não se volta a ler a base de dados e snapshots de execuções anteriores nunca são mais recentes
+with background_cache.transact():
+    SEED_DATA_VERSION = next_data_version()
+    publish_data_version(SEED_DATA_VERSION)
+
+_snapshot_lock = threading.Lock()
+_snapshot_atual = {
+    "data_version": SEED_DATA_VERSION,
+    "snapshot": {
+        "utente": df_utente,
+        "medicacao": (df, df_grouped, df_yearly_cost),
+        "consultas": (df_consultas, df_alerta, num_processos_alerta),
+        "timeline": build_consultas_timeline(df_consultas),
+    },
+    "loading": None,
+}
+
+
+def load_snapshot(data_version):
+    # Um só snapshot por processo e as versões só avançam. O ficheiro é lido fora do lock;
+    # só esperam os pedidos que precisam da versão que está a ser carregada.
+    while True:
+        with _snapshot_lock:
+            if data_version <= _snapshot_atual["data_version"]:
+                return _snapshot_atual["snapshot"]
+            carregamento = _snapshot_atual["loading"]
+            if carregamento is None:
+                _snapshot_atual["loading"] = threading.Event()
+                break
+
+        carregamento.wait()
+
+    try:
+        # Sem ficheiro, a versão é o arranque de outro worker: os dados deste processo são igualmente recentes
+        path = snapshot_path(data_version)
+        snapshot = pd.read_pickle(path) if os.path.exists(path) else None
+
+        with _snapshot_lock:
+            if data_version > _snapshot_atual["data_version"]:
+                if snapshot is not None:
+                    _snapshot_atual["snapshot"] = snapshot
+                _snapshot_atual["data_version"] = data_version
+            return _snapshot_atual["snapshot"]
+    finally:
+        with _snapshot_lock:
+            carregamento = _snapshot_atual["loading"]
+            _snapshot_atual["loading"] = None
+        carregamento.set()
+
+
+#____________________________________________________________________________________________________DERIVED CACHE________________________________
+
+# Orçamento por worker: com gunicorn a memória total é workers x DERIVED_CACHE_MB_PER_WORKER
+DERIVED_CACHE_MB_PER_WORKER = int(os.getenv("DERIVED_CACHE_MB_PER_WORKER", "256"))
+CACHE_STATS_TOKEN = os.getenv("CACHE_STATS_TOKEN")
+
+_MISS = object()
+
+
+def normalizar_inputs(*args):
+    # Nos filtros multi-select a ordem e a diferença entre None e [] não mudam o resultado
+    normalizados = []
+    for valor in args:
+        if isinstance(valor, list):
+            valor = tuple(sorted(valor, key=str)) if valor else None
+        normalizados.append(valor)
+    return tuple(normalizados)
+
+
+class DerivedCache:
+    # Cache LRU por processo (cada worker tem a sua) para resultados dos callbacks, limitada em memória.
+    # Chave: (versão dos dados, callback, inputs normalizados); uma versão nova invalida as anteriores.
+    # Os valores ficam guardados em pickle: o tamanho contado é o ocupado e ninguém altera o objeto guardado.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self._data_version = 0
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _aceitar_versao(self, data_version):
+        # Só avança de versão; pedidos de uma versão anterior não usam nem alteram a cache
+        if data_version < self._data_version:
+            return False
+        if data_version != self._data_version:
+            if self._entradas:
+                self._stats["invalidations"] += 1
+            self._entradas.clear()
+            self._bytes = 0
+            self._data_version = data_version
+        return True
+
+    def get(self, chave):
+        with self._lock:
+            if not self._aceitar_versao(chave[0]) or chave not in self._entradas:
+                self._stats["misses"] += 1
+                return _MISS
+            self._entradas.move_to_end(chave)
+            self._stats["hits"] += 1
+            dados = self._entradas[chave]
+        return pickle.loads(dados)
+
+    def set(self, chave, valor):
+        dados = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(dados) > self.max_bytes:
+            return
+
+        with self._lock:
+            if not self._aceitar_versao(chave[0]):
+                return
+            if chave in self._entradas:
+                self._bytes -= len(self._entradas.pop(chave))
+            self._entradas[chave] = dados
+            self._bytes += len(dados)
+
+            # Remove as entradas menos usadas até caber no orçamento
+            while self._bytes > self.max_bytes:
+                _, dados_removidos = self._entradas.popitem(last=False)
+                self._bytes -= len(dados_removidos)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entradas),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "data_version": self._data_version,
+            }
+
+    def memoize(self, nome, data_version_arg):
+        # data_version_arg: parâmetro que recebe o data-version do cliente. Fica fora da chave e é
+        # substituído pela versão publicada, lida uma só vez e usada para carregar os dados.
+        def decorador(funcao):
+            posicao = list(inspect.signature(funcao).parameters).index(data_version_arg)
+
+            @wraps(funcao)
+            def wrapper(*args):
+                data_version = current_data_version()
+                args = args[:posicao] + (data_version,) + args[posicao + 1:]
+                chave = (data_version, nome, normalizar_inputs(*(args[:posicao] + args[posicao + 1:])))
+                resultado = self.get(chave)
+                if resultado is _MISS:
+                    resultado = funcao(*args)
+                    self.set(chave, resultado)
+                return resultado
+            return wrapper
+        return decorador
+
+
+derived_cache = DerivedCache(DERIVED_CACHE_MB_PER_WORKER * 1024 * 1024)
+
+
 # Create a Dash App__________________________________________________________________________________________________________________________________________
-app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
+app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True,
+           background_callback_manager=background_callback_manager)
 
 # Layout definition with Tabs
 app.layout = dbc.Container([
@@ -277,27 +605,77 @@ app.layout = dbc.Container([
         ], id="medicacao-filters"),
         id="medicacao-filters-container"
     ),
+
+    # Estado do refresh em background
+    dbc.Row([
+        dbc.Col(html.Small(id="refresh-status", className="text-muted"), width="auto"),
+        dbc.Col(html.Small(id="refresh-progress", className="text-muted", style={"display": "none"}), width="auto")
+    ], className="mt-2"),
+    dcc.Store(id="refresh-trigger"),
+    dcc.Store(id="data-version"),
     dcc.Interval(id='interval-component', interval=60000*5, n_intervals=0)
 ])
 
 # CALLBACKS MEDICAÇÃO________________________________________________________________________________________________________________________________
 
-from flask_caching import Cache
+# Os dados vêm do último snapshot publicado pelo refresh em background (ver refresh_data)
+def cached_get_utente_data(data_version):
+    return load_snapshot(data_version)["utente"]
+
+def cached_get_medicacao_data(data_version):
+    return load_snapshot(data_version)["medicacao"]
 
-# Initialize cache for the app
-cache = Cache(app.server, config={'CACHE_TYPE': 'SimpleCache'})
+def cached_get_consulta_data(data_version):
+    return load_snapshot(data_version)["consultas"]
 
-# Cache data loading functions for 5 minutes (adjust timeout as needed)
-@cache.memoize(timeout=300)
-def cached_get_medicacao_data():
-    return get_medicacao_data()
+def cached_get_consultas_timeline(data_version):
+    return load_snapshot(data_version)["timeline"]
 
-@cache.memoize(timeout=300)
-def cached_get_consulta_data(df_utente, data_limite_custom=None):
-    return get_consulta_data(df_utente, data_limite_custom)
+# Verificação barata a cada intervalo: só dispara o job de refresh quando os dados estão desatualizados
+@app.callback(
+    Output("refresh-trigger", "data"),
+    Output("data-version", "data"),
+    Output("refresh-status", "children"),
+    Input("interval-component", "n_intervals"),
+    State("data-version", "data"),
+)
+def check_refresh(n_intervals, client_data_version):
+    data_version = current_data_version()
+    trigger = n_intervals if claim_refresh() else dash.no_update
+
+    if refresh_running():
+        status = "A atualizar dados..."
+    else:
+        refreshed_at = background_cache.get("data_refreshed_at", time.time())
+        status = f"Dados atualizados em {datetime.fromtimestamp(refreshed_at).strftime('%d/%m/%Y %H:%M')}."
+
+    if data_version == client_data_version:
+        return trigger, dash.no_update, status
+
+    return trigger, data_version, status
+
+# Refresh dos dados num processo separado: os callbacks interativos continuam a responder.
+# É partilhado por todos os utilizadores, por isso não tem botão de cancelar.
+@app.callback(
+    Output("data-version", "data", allow_duplicate=True),
+    Input("refresh-trigger", "data"),
+    background=True,
+    progress=Output("refresh-progress", "children"),
+    running=[(Output("refresh-progress", "style"), {"display": "inline"}, {"display": "none"})],
+    prevent_initial_call=True,
+)
+def refresh_data(set_progress, trigger):
+    # Defesa extra: mesmo com o pedido reservado em claim_refresh, só um processo faz o refresh
+    if not acquire_refresh_lock():
+        return dash.no_update
 
-# Increase interval to 60 seconds (adjust in your layout component too)
-# Example for interval-component: dcc.Interval(id='interval-component', interval=60*1000, n_intervals=0)
+    try:
+        engine.dispose(close=False)  # não reutilizar as ligações herdadas do processo pai
+        snapshot = build_snapshot(set_progress)
+        set_progress("A guardar dados...")
+        return write_snapshot(snapshot)
+    finally:
+        release_refresh_lock()
 
 # Callback to Show/Hide Title and Filters Based on Selected Tab
 @app.callback(
@@ -325,10 +703,11 @@ def update_content(active_tab, n_intervals):
     Input("processo-dropdown", "value"),
     Input("medicamento-dropdown", "value"),
     Input("year-dropdown", "value"),
-    Input("interval-component", "n_intervals")
+    Input("data-version", "data")
 )
-def update_cost_barplot(selected_processes, selected_medications, selected_years, n_intervals):
-    df, _, df_yearly_cost = cached_get_medicacao_data()
+@derived_cache.memoize("update_cost_barplot", data_version_arg="data_version")
+def update_cost_barplot(selected_processes, selected_medications, selected_years, data_version):
+    df, _, df_yearly_cost = cached_get_medicacao_data(data_version)
     filtered_df = df.copy()
 
 
@@ -352,13 +731,14 @@ def update_cost_barplot(selected_processes, selected_medications, selected_years
     Input("tabs", "active_tab"),
     Input("processo-dropdown", "value"),
     Input("medicamento-dropdown", "value"),
-    Input("interval-component", "n_intervals")
+    Input("data-version", "data")
 )
-def update_gantt_chart(active_tab, selected_processes, selected_medications, n_intervals):
+@derived_cache.memoize("update_gantt_chart", data_version_arg="data_version")
+def update_gantt_chart(active_tab, selected_processes, selected_medications, data_version):
     if active_tab != "medicacao":
         return go.Figure()
 
-    _, df_grouped, _ = cached_get_medicacao_data()
+    _, df_grouped, _ = cached_get_medicacao_data(data_version)
 
     # If no process selected, show all
     if not selected_processes:
@@ -395,10 +775,11 @@ def update_gantt_chart(active_tab, selected_processes, selected_medications, n_i
     Input("processo-dropdown", "value"),
     Input("medicamento-dropdown", "value"),
     Input("year-dropdown", "value"),
-    Input("interval-component", "n_intervals")
+    Input("data-version", "data")
 )
-def update_piechart(selected_processes, selected_medications, selected_years, n_intervals):
-    df, _, _ = cached_get_medicacao_data()
+@derived_cache.memoize("update_piechart", data_version_arg="data_version")
+def update_piechart(selected_processes, selected_medications, selected_years, data_version):
+    df, _, _ = cached_get_medicacao_data(data_version)
 
     filtered_df = df
     if selected_processes:
@@ -434,6 +815,21 @@ def render_tab_content(active_tab):
                     width="auto",
                     style={"marginBottom": "10px"}
                 ),
+                dbc.Col(
+                    html.Button("Cancelar exportação", id="btn_cancel_export", className="btn btn-secondary",
+                                style={"display": "none"}),
+                    width="auto",
+                    style={"marginBottom": "10px"}
+                ),
+                dbc.Col(
+                    dbc.Progress(id="export-progress", value=0, max=1),
+                    width=3,
+                    className="d-flex align-items-center",
+                    style={"marginBottom": "10px"}
+                ),
+                dbc.Col(html.Small(id="export-status", className="text-muted"), width="auto",
+                        className="d-flex align-items-center", style={"marginBottom": "10px"}),
+                dcc.Store(id="export-trigger"),
                 dcc.Download(id="download-dataframe-xlsx")
             ]),
 
@@ -545,17 +941,18 @@ def render_tab_content(active_tab):
     Output("alerta-table", "data"),
     Input("consulta-date-picker", "date"),
     Input("include-deceased-checklist", "value"),
-    Input("interval-component", "n_intervals")
+    Input("data-version", "data")
 )
-def update_alerta_dropdown_and_table(selected_date, include_deceased_values, n_intervals, sort_order="asc"):
+@derived_cache.memoize("update_alerta_dropdown_and_table", data_version_arg="data_version")
+def update_alerta_dropdown_and_table(selected_date, include_deceased_values, data_version, sort_order="asc"):
     if not selected_date:
         print("Nenhuma data selecionada.")
         return [], [], []
 
     print(f"Data selecionada: {selected_date}")
 
-    df_consultas, _, _ = cached_get_consulta_data(df_utente, data_limite_custom=selected_date)
-    df_utente_info = get_utente_data()
+    df_consultas, _, _ = cached_get_consulta_data(data_version)
+    df_utente_info = cached_get_utente_data(data_version)
 
     print(f"Consultas carregadas: {len(df_consultas)} registros")
     print(f"Info utente carregada: {len(df_utente_info)} registros")
@@ -626,56 +1023,87 @@ def update_alerta_dropdown_and_table(selected_date, include_deceased_values, n_i
     return dropdown_options, table_columns, table_data
 
 
+def build_excel(set_progress, table_data):
+    # Converte os dados da tabela (lista de dicts) para DataFrame
+    df_export = pd.DataFrame(table_data)
+
+    # Opcional: podes definir um nome dinâmico para o ficheiro
+    filename = "dados_alerta.xlsx"
+
+    # Escreve o xlsx por blocos para reportar o progresso
+    total = len(df_export)
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        for inicio in range(0, total, EXPORT_CHUNK_ROWS):
+            df_export.iloc[inicio:inicio + EXPORT_CHUNK_ROWS].to_excel(
+                writer, sheet_name="Dados", index=False,
+                header=inicio == 0, startrow=inicio + 1 if inicio else 0
+            )
+            set_progress((min(inicio + EXPORT_CHUNK_ROWS, total), total))
+
+    return dcc.send_bytes(buffer.getvalue(), filename)
+
+# Verifica se há capacidade antes de lançar o job: cada exportação corre num processo próprio
 @app.callback(
-    Output("download-dataframe-xlsx", "data"),
+    Output("export-trigger", "data"),
+    Output("export-status", "children"),
     Input("btn_export", "n_clicks"),
     State("alerta-table", "data"),
     prevent_initial_call=True,
 )
-def export_to_excel(n_clicks, table_data):
-    if not n_clicks:
-        return dash.no_update
+def request_export(n_clicks, table_data):
+    if not n_clicks or not table_data:
+        return dash.no_update, ""
 
-    if not table_data:
-        return dash.no_update
+    if not export_slot_available():
+        return dash.no_update, "Há demasiadas exportações em curso. Tente novamente dentro de momentos."
 
-    # Converte os dados da tabela (lista de dicts) para DataFrame
-    df_export = pd.DataFrame(table_data)
+    return n_clicks, ""
 
-    # Opcional: podes definir um nome dinâmico para o ficheiro
-    filename = "dados_alerta.xlsx"
+@app.callback(
+    Output("download-dataframe-xlsx", "data"),
+    Input("export-trigger", "data"),
+    State("alerta-table", "data"),
+    background=True,
+    progress=[Output("export-progress", "value"), Output("export-progress", "max")],
+    running=[
+        (Output("btn_export", "disabled"), True, False),
+        (Output("btn_cancel_export", "style"), {"display": "inline-block"}, {"display": "none"}),
+    ],
+    cancel=[Input("btn_cancel_export", "n_clicks")],
+    prevent_initial_call=True,
+)
+def export_to_excel(set_progress, trigger, table_data):
+    if not table_data or not acquire_export_slot():
+        return dash.no_update
+
+    try:
+        return build_excel(set_progress, table_data)
+    finally:
+        release_export_slot()
 
-    return dcc.send_data_frame(df_export.to_excel, filename, sheet_name="Dados", index=False)
 
 # Update Consultas Plot
 @app.callback(
     Output("consultas-plot", "figure"),
     Input("processo-dropdown-consultas", "value"),
     Input("consulta-date-picker", "date"),
-    Input("interval-component", "n_intervals")
+    Input("data-version", "data")
 )
-def update_consultas_plot(selected_process, selected_date, n_intervals):
+@derived_cache.memoize("update_consultas_plot", data_version_arg="data_version")
+def update_consultas_plot(selected_process, selected_date, data_version):
     if not selected_process or not selected_date:
         return go.Figure()
 
-    df_consultas, _, _ = cached_get_consulta_data(df_utente, data_limite_custom=selected_date)
-    df_filtered = df_consultas[df_consultas["PROCESSO"] == selected_process]
+    # Slice O(1) no índice por utente (já ordenado por data e com TIPO_ACTIVIDADE_DESC descodificado)
+    df_timeline, offsets = cached_get_consultas_timeline(data_version)
+    df_filtered = get_consultas_processo(df_timeline, offsets, selected_process)
 
     if df_filtered.empty:
         return go.Figure()
 
-    # Convert once, safely
-    df_filtered = df_filtered.copy()
-    df_filtered["CODTIPOACTIVIDADE"] = pd.to_numeric(df_filtered["CODTIPOACTIVIDADE"], errors="coerce").astype("Int64")
-
-    tipo_map = {
-        1: "PRIMEIRA CONSULTA",
-        2: "CONSULTA SUBSEQUENTE"
-    }
-    df_filtered["TIPO_ACTIVIDADE_DESC"] = df_filtered["CODTIPOACTIVIDADE"].map(tipo_map).fillna("OUTRO")
-
     fig = px.scatter(
-        df_filtered.sort_values("DATACONSULTA"),
+        df_filtered,
         x="DATACONSULTA",
         y="TIPO_ACTIVIDADE_DESC",
         color="AGENDA_PROTECTED",
@@ -698,6 +1126,14 @@ def update_consultas_plot(selected_process, selected_date, n_intervals):
 # Run the app
 server = app.server  # necessário para gunicorn/Render
 
+@server.route("/cache-stats")
+def cache_stats():
+    # Estatísticas do worker que atende o pedido (a cache é por processo); só com CACHE_STATS_TOKEN
+    token = flask.request.headers.get("X-Cache-Stats-Token", "")
+    if not CACHE_STATS_TOKEN or not hmac.compare_digest(token, CACHE_STATS_TOKEN):
+        flask.abort(404)
+    return {"pid": os.getpid(), **derived_cache.stats()}
+
 if __name__ == "__main__":
     app.run_server(debug=True)
 